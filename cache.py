@@ -0,0 +1,198 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any
+
+from anthropic.types import Message
+from mcp.types import CallToolResult
+
+# SQLite file used to persist Claude responses between restarts
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.db")
+
+# How long (in seconds) a cached Claude response stays valid
+RESPONSE_CACHE_TTL = 3600
+
+# Expired responses are purged once every this many writes
+RESPONSE_CACHE_PURGE_EVERY = 100
+
+# Only these MCP tools are treated as side-effect free and have their results cached
+# (comma separated, e.g. CACHEABLE_TOOLS=search_candidates,list_jobs)
+CACHEABLE_TOOLS: set[str] = {
+    name.strip() for name in os.getenv("CACHEABLE_TOOLS", "").split(",") if name.strip()
+}
+
+# How long (in seconds) a cached tool result stays valid, and how many are kept
+TOOL_CACHE_TTL = 300
+TOOL_CACHE_SIZE = 1024
+
+
+def _to_jsonable(obj: Any) -> Any:
+    """
+    JSON fallback for SDK objects (content blocks, MCP tool results).
+    """
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(mode="json", exclude_none=True)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+class ResponseCache:
+    """
+    An exact-match cache for Claude responses, backed by SQLite.
+    Entries are keyed by a hash of every argument sent to messages.create.
+    """
+
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, ttl: int = RESPONSE_CACHE_TTL):
+        self.ttl = ttl
+        # Queries run in asyncio.to_thread worker threads, one at a time under the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # WAL with synchronous=NORMAL avoids an fsync on every commit
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key BLOB PRIMARY KEY, payload BLOB NOT NULL, expires_at INTEGER NOT NULL)"
+        )
+        self._writes = 0
+        self._purge_expired()
+        self._conn.commit()
+
+    def _purge_expired(self) -> None:
+        """
+        Deletes expired rows. Callers must hold the lock (or be in __init__).
+        """
+        self._conn.execute("DELETE FROM responses WHERE expires_at <= ?", (int(time.time()),))
+
+    @staticmethod
+    def make_key(**request: Any) -> bytes:
+        """
+        Builds a stable SHA-256 key from a messages.create request.
+        Keys are sorted and text is NFC-normalized so equivalent requests hash the same.
+        """
+        request["model"] = request["model"].lower()
+        encoded = json.dumps(
+            request,
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+            default=_to_jsonable,
+        )
+        return hashlib.sha256(unicodedata.normalize("NFC", encoded).encode()).digest()
+
+    def get(self, key: bytes) -> Message | None:
+        """
+        Returns the cached response for a key, or None if missing or expired.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload FROM responses WHERE key = ? AND expires_at > ?",
+                (key, int(time.time())),
+            ).fetchone()
+        if row is None:
+            return None
+        return Message.model_validate_json(row[0])
+
+    def set(self, key: bytes, response: Message) -> None:
+        """
+        Stores a Claude response under the given key.
+        """
+        payload = response.model_dump_json().encode()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, payload, expires_at) VALUES (?, ?, ?)",
+                (key, payload, int(time.time()) + self.ttl),
+            )
+            # Sweep expired rows every few writes so the file doesn't grow without bound
+            self._writes += 1
+            if self._writes % RESPONSE_CACHE_PURGE_EVERY == 0:
+                self._purge_expired()
+            self._conn.commit()
+
+    async def aget(self, key: bytes) -> Message | None:
+        """
+        Like get, but runs the SQLite query off the event loop.
+        """
+        return await asyncio.to_thread(self.get, key)
+
+    async def aset(self, key: bytes, response: Message) -> None:
+        """
+        Like set, but runs the SQLite write off the event loop.
+        """
+        await asyncio.to_thread(self.set, key, response)
+
+    def clear(self) -> None:
+        """
+        Drops every cached response.
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ToolResultCache:
+    """
+    An in-memory TTL + LRU cache for MCP tool results.
+    Only tools listed in CACHEABLE_TOOLS are cached; anything else may mutate state.
+    """
+
+    def __init__(
+        self,
+        cacheable: set[str] = CACHEABLE_TOOLS,
+        ttl: float = TOOL_CACHE_TTL,
+        maxsize: int = TOOL_CACHE_SIZE,
+    ):
+        self.cacheable = cacheable
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: OrderedDict[bytes, tuple[float, CallToolResult]] = OrderedDict()
+
+    @staticmethod
+    def make_key(tool_name: str, tool_args: dict[str, Any] | None) -> bytes:
+        encoded_args = json.dumps(tool_args, sort_keys=True, separators=(",", ":"))
+        return hashlib.blake2b(tool_name.encode() + b"\0" + encoded_args.encode()).digest()
+
+    def get(self, tool_name: str, tool_args: dict[str, Any] | None) -> CallToolResult | None:
+        """
+        Returns the cached result of a tool call, or None if missing or expired.
+        """
+        if tool_name not in self.cacheable:
+            return None
+
+        key = self.make_key(tool_name, tool_args)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+
+        expires_at, result = entry
+        if time.monotonic() >= expires_at:
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return result
+
+    def set(self, tool_name: str, tool_args: dict[str, Any] | None, result: CallToolResult) -> None:
+        """
+        Stores a successful tool result, evicting the least recently used entry when full.
+        """
+        if tool_name not in self.cacheable or result.isError:
+            return
+
+        key = self.make_key(tool_name, tool_args)
+        self._entries[key] = (time.monotonic() + self.ttl, result)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
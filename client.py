@@ -1,18 +1,100 @@
-from contextlib import AsyncExitStack
-import traceback
+import asyncio
+import hashlib
+import io
+import json
+import logging
+import os
+import time
+import types
+from collections.abc import AsyncIterator, Awaitable
+from datetime import timedelta
+from typing import TypeVar
 from dotenv import load_dotenv
 
-from anthropic import Anthropic, APIStatusError
-from mcp import ClientSession
+import httpx
+from anthropic import AsyncAnthropic, APIStatusError
+from anthropic.types import Message
+from mcp import ClientSession, McpError
+from mcp.types import CallToolResult
 from mcp.client.streamable_http import streamablehttp_client
 
+from cache import ResponseCache, ToolResultCache
+
 # Default MCP server URL (replace with your actual MCP server endpoint)
 MCP_CLIENT_URL = "http://0.0.0.0:8000/recruit/mcp"
 
+# How long (in seconds) the MCP tool list is cached before being re-fetched
+TOOLS_CACHE_TTL = 300
+
+# Upper bound (in seconds) on a single MCP request, so calls on a dead session cannot hang forever.
+# Raise it for slow tools; 0 disables the limit.
+MCP_REQUEST_TIMEOUT = float(os.getenv("MCP_REQUEST_TIMEOUT", "120"))
+
+# Connection attempts per session open, with exponential backoff between them
+SESSION_CONNECT_RETRIES = 3
+SESSION_RETRY_BACKOFF = 0.5
+
+# Circuit breaker: open after this many consecutive MCP failures,
+# then fail fast for BREAKER_COOLDOWN seconds before trying again
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+
+# Claude model settings shared by every request
+CLAUDE_MODEL = "claude-3-5-sonnet-20241022"
+CLAUDE_SYSTEM = "You are a helpful AI assistant. The output should be human readable"
+CLAUDE_MAX_TOKENS = 1000
+
+# Read-only so the arguments (and response cache keys) stay identical across calls
+_BASE_KWARGS = types.MappingProxyType({
+    "model": CLAUDE_MODEL,
+    "max_tokens": CLAUDE_MAX_TOKENS,
+    "system": CLAUDE_SYSTEM,
+})
+
+# Cap on concurrent Claude requests across all Uvicorn workers; extra queries wait for a free slot.
+# Every worker process has its own semaphore, so each gets an equal share of the budget.
+MCP_MAX_INFLIGHT = int(os.getenv("MCP_MAX_INFLIGHT", "64"))
+WORKER_COUNT = int(os.getenv("WEB_CONCURRENCY") or 1)
+LLM_SLOTS_PER_WORKER = max(1, MCP_MAX_INFLIGHT // WORKER_COUNT)
+# Log a warning when waiting longer than this for a slot, give up after LLM_SLOT_TIMEOUT (seconds)
+LLM_SLOT_WARN_AFTER = 1.0
+LLM_SLOT_TIMEOUT = 30.0
+
+# Queries starting with this prefix skip the Claude response cache and refresh it
+CACHE_BUST_PREFIX = "!bust"
+
+logger = logging.getLogger("mcp_client")
+
+T = TypeVar("T")
+
 # Load environment variables from .env file (if used for ANTHROPIC_API_KEY update .env with your api key.)
 load_dotenv()
 
 
+def _unwrap(error: Exception) -> Exception:
+    """
+    Returns the lone exception inside (possibly nested) single-exception groups.
+    """
+    while isinstance(error, ExceptionGroup) and len(error.exceptions) == 1:
+        error = error.exceptions[0]
+    return error
+
+
+def _session_lost(error: McpError) -> bool:
+    """
+    Whether an MCP error means the session itself is gone rather than the request failing.
+    The streamable HTTP transport reports a 404 (server restarted or dropped the session)
+    as code 32600 "Session terminated"; later SDKs report a dead transport as "Connection closed".
+    """
+    return error.error.code == 32600 or error.error.message in ("Session terminated", "Connection closed")
+
+
+class ClaudeBusyError(RuntimeError):
+    """
+    Raised when a query waited too long for a free Claude request slot.
+    """
+
+
 class MCPClient:
     """
     A sample MCP Client that connects to a running MCP server,
@@ -21,130 +103,460 @@ class MCPClient:
 
     def __init__(self, server_url: str = MCP_CLIENT_URL):
         self.server_url = server_url
-        self.exit_stack = AsyncExitStack()
-        self.anthropic = Anthropic()  # Claude API client
+        # Pooled HTTP client so connections to the Claude API are kept alive and reused
+        self._http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_keepalive_connections=100,
+                max_connections=200,
+                keepalive_expiry=30.0,
+            ),
+            timeout=httpx.Timeout(60.0),
+        )
+        self.anthropic = AsyncAnthropic(http_client=self._http)  # Claude API client
+        self._llm_sem = asyncio.Semaphore(LLM_SLOTS_PER_WORKER)  # Bounds this worker's Claude requests
+        self.response_cache = ResponseCache()  # Cache of Claude responses
+        self.tool_cache = ToolResultCache()  # Cache of read-only MCP tool results
 
-    async def test_connection(self):
+        # Long-lived MCP session, opened lazily and reused by every query.
+        # It is owned by a background task that runs until _session_stop is set.
+        self._session: ClientSession | None = None
+        self._session_task: asyncio.Task | None = None
+        self._session_stop: asyncio.Event | None = None
+        self._session_lock = asyncio.Lock()
+
+        # Circuit breaker state: "closed" (normal), "open" (fail fast) or "half" (probing)
+        self._breaker_state = "closed"
+        self._fail_count = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+        # Cached tool metadata in the format Claude expects, plus a fingerprint
+        # of it so the response cache never has to re-encode the tool list
+        self._tools_cache: tuple[dict, ...] | None = None
+        self._tools_fingerprint: str = ""
+        self._tools_expiry: float = 0.0
+        self._tools_lock = asyncio.Lock()
+
+    def _check_breaker(self) -> None:
         """
-        Checks if the MCP server is reachable and tools can be listed.
-        Used at app startup for health checks.
+        Fails fast while the circuit is open; lets a probe through once the cooldown has passed.
         """
+        if self._breaker_state == "open":
+            if time.monotonic() - self._opened_at < BREAKER_COOLDOWN:
+                raise RuntimeError("MCP circuit open")
+            self._breaker_state = "half"
+
+    def _admit_query(self) -> bool:
+        """
+        Lets a query through the circuit breaker.
+        Returns True if it is the single half-open probe, whose outcome decides whether the circuit closes.
+        """
+        self._check_breaker()
+        if self._breaker_state != "half":
+            return False
+        if self._probe_in_flight:
+            raise RuntimeError("MCP circuit open")
+        self._probe_in_flight = True
+        return True
+
+    def _record_success(self) -> None:
+        if self._breaker_state != "closed":
+            logger.info("MCP circuit closed")
+        self._breaker_state = "closed"
+        self._fail_count = 0
+
+    def _record_failure(self) -> None:
+        self._fail_count += 1
+        if self._breaker_state == "half" or self._fail_count >= BREAKER_FAILURE_THRESHOLD:
+            if self._breaker_state != "open":
+                logger.warning("MCP circuit opened after %d consecutive failures", self._fail_count)
+            self._breaker_state = "open"
+            self._opened_at = time.monotonic()
+
+    async def _run_session(self, ready: asyncio.Future, stop: asyncio.Event) -> None:
+        """
+        Owns the MCP transport and session for their whole lifetime.
+        Running them in their own task keeps a transport failure from cancelling
+        whichever request (or lifespan) task happened to open the session.
+        """
+        session = None
         try:
             async with streamablehttp_client(self.server_url) as (read_stream, write_stream, _):
-                async with ClientSession(read_stream, write_stream) as session:
+                async with ClientSession(
+                    read_stream,
+                    write_stream,
+                    read_timeout_seconds=timedelta(seconds=MCP_REQUEST_TIMEOUT) if MCP_REQUEST_TIMEOUT else None,
+                ) as session:
                     await session.initialize()
-                    await session.list_tools()
+                    ready.set_result(session)
+                    await stop.wait()
+        except Exception as e:
+            # Surface the transport's real error rather than its TaskGroup wrapper
+            e = _unwrap(e)
+            if not ready.done():
+                ready.set_exception(e)
+            else:
+                logger.warning("MCP session closed unexpectedly: %s", e)
+        finally:
+            if not ready.done():
+                ready.cancel()
+            # Forget the session so the next query reconnects
+            if session is not None and self._session is session:
+                self._session = None
+
+    async def _open_session(self) -> None:
+        """
+        Opens the shared MCP session, retrying a few times with backoff.
+        A failed open counts as one failure for the circuit breaker.
+        """
+        last_error: Exception | None = None
+        for attempt in range(SESSION_CONNECT_RETRIES):
+            if attempt:
+                await asyncio.sleep(SESSION_RETRY_BACKOFF * 2 ** (attempt - 1))
+
+            ready = asyncio.get_running_loop().create_future()
+            stop = asyncio.Event()
+            task = asyncio.create_task(self._run_session(ready, stop))
+            try:
+                session = await ready
+            except Exception as e:
+                last_error = e
+                logger.warning(
+                    "MCP connection attempt %d/%d failed: %s", attempt + 1, SESSION_CONNECT_RETRIES, e
+                )
+                await asyncio.gather(task, return_exceptions=True)
+                continue
+
+            self._session, self._session_task, self._session_stop = session, task, stop
+            self._record_success()
+            return
+
+        self._record_failure()
+        raise RuntimeError(f"Failed to open MCP session: {last_error}")
+
+    async def _close_session(self) -> None:
+        """
+        Signals the session task to close the MCP session and waits for it to finish.
+        """
+        task, stop = self._session_task, self._session_stop
+        self._session = self._session_task = self._session_stop = None
+        if task is not None:
+            stop.set()
+            await asyncio.gather(task, return_exceptions=True)
+
+    async def _drop_session(self, session_task: asyncio.Task | None) -> None:
+        """
+        Closes a session that was lost mid-request so the next query reconnects.
+        Concurrent requests on the same dead session count as one breaker failure.
+        """
+        if session_task is not None and self._session_task is session_task:
+            await self._close_session()
+            self._record_failure()
+
+    async def _mcp_request(self, request: Awaitable[T]) -> T:
+        """
+        Awaits one MCP request on the shared session, failing fast if the session task
+        ends first instead of waiting out MCP_REQUEST_TIMEOUT for a reply that never comes.
+        Lost sessions are closed and counted by the circuit breaker; other McpErrors
+        (tool or server errors, slow tools timing out) are passed through as is.
+        """
+        session_task = self._session_task
+        pending = asyncio.ensure_future(request)
+        try:
+            if session_task is not None:
+                await asyncio.wait((pending, session_task), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if not pending.done():
+                pending.cancel()
+                await asyncio.gather(pending, return_exceptions=True)
+
+        if pending.cancelled():
+            await self._drop_session(session_task)
+            raise RuntimeError("MCP session closed while waiting for a response")
+        try:
+            return await pending
+        except McpError as e:
+            if _session_lost(e):
+                logger.warning("MCP session lost: %s", e.error.message)
+                await self._drop_session(session_task)
+            raise
+        except Exception:
+            # Repeated transport failures trip the circuit breaker too
+            self._record_failure()
+            raise
+
+    async def _ensure_session(self) -> ClientSession:
+        """
+        Returns the shared MCP session, opening the transport and
+        running the MCP handshake on first use (or after the session died).
+        Raises RuntimeError straight away while the circuit breaker is open.
+        """
+        self._check_breaker()
+        if self._session is not None:
+            return self._session
+
+        async with self._session_lock:
+            # Another coroutine may have opened the session while we waited
+            if self._session is None:
+                self._check_breaker()
+                await self._close_session()  # Reap the task of a session that died
+                await self._open_session()
+        return self._session
+
+    async def _get_tools(self) -> tuple[dict, ...]:
+        """
+        Returns the MCP server's tools formatted for Claude.
+        The tuple is cached for TOOLS_CACHE_TTL seconds since the
+        tool catalog rarely changes while the server is running,
+        and the same object is passed to every Claude call.
+        """
+        if self._tools_cache is not None and time.monotonic() < self._tools_expiry:
+            return self._tools_cache
+
+        async with self._tools_lock:
+            # Another coroutine may have refreshed the cache while we waited
+            if self._tools_cache is None or time.monotonic() >= self._tools_expiry:
+                session = await self._ensure_session()
+                tool_response = await self._mcp_request(session.list_tools())
+                tools = tuple(
+                    {
+                        "name": tool.name,
+                        "description": tool.description,
+                        "input_schema": tool.inputSchema,
+                    }
+                    for tool in tool_response.tools
+                )
+                self._tools_fingerprint = hashlib.sha256(
+                    json.dumps(tools, sort_keys=True).encode()
+                ).hexdigest()
+                self._tools_cache = tools
+                self._tools_expiry = time.monotonic() + TOOLS_CACHE_TTL
+        return self._tools_cache
+
+    def invalidate_tools(self) -> None:
+        """
+        Forces the tool list to be re-fetched on the next query.
+        """
+        self._tools_expiry = 0.0
+
+    async def _acquire_llm_slot(self) -> None:
+        """
+        Waits for one of this worker's LLM_SLOTS_PER_WORKER Claude request slots.
+        Raises ClaudeBusyError if no slot frees up within LLM_SLOT_TIMEOUT seconds.
+        """
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(self._llm_sem.acquire(), LLM_SLOT_TIMEOUT)
+        except TimeoutError:
+            logger.warning("No Claude request slot free after %.1fs", LLM_SLOT_TIMEOUT)
+            raise ClaudeBusyError("Too many concurrent Claude requests, try again later")
+
+        waited = time.monotonic() - started
+        if waited > LLM_SLOT_WARN_AFTER:
+            logger.warning("Waited %.2fs for a Claude request slot", waited)
+
+    async def _stream_message(self, bypass_cache: bool = False, **kwargs) -> AsyncIterator[str | Message]:
+        """
+        Streams a Claude response, yielding text as it arrives and then the complete Message.
+        Identical requests are replayed from the response cache.
+        With bypass_cache the cache is not read, but the fresh response is stored.
+        """
+        key_request = kwargs
+        if kwargs.get("tools") is self._tools_cache:
+            # Identify the cached tool list by its fingerprint instead of re-encoding it
+            key_request = {**kwargs, "tools": self._tools_fingerprint}
+        key = ResponseCache.make_key(**key_request)
+        response = None if bypass_cache else await self.response_cache.aget(key)
+
+        if response is not None:
+            for content in response.content:
+                if content.type == "text":
+                    yield content.text + "\n"
+        else:
+            await self._acquire_llm_slot()
+            try:
+                async with self.anthropic.messages.stream(**kwargs) as stream:
+                    async for event in stream:
+                        if event.type == "text":
+                            yield event.text
+                        elif event.type == "content_block_stop" and event.content_block.type == "text":
+                            # Keep text blocks on separate lines, as in the buffered response
+                            yield "\n"
+                    response = await stream.get_final_message()
+            finally:
+                self._llm_sem.release()
+            await self.response_cache.aset(key, response)
+
+        yield response
+
+    async def _call_tool(self, session: ClientSession, tool_name: str, tool_args: dict) -> CallToolResult:
+        """
+        Calls an MCP tool, serving repeated calls to cacheable tools from the tool cache.
+        """
+        tool_result = self.tool_cache.get(tool_name, tool_args)
+        if tool_result is None:
+            tool_result = await self._mcp_request(session.call_tool(tool_name, tool_args))
+            self._record_success()
+            self.tool_cache.set(tool_name, tool_args, tool_result)
+        return tool_result
+
+    @property
+    def is_connected(self) -> bool:
+        """
+        Whether the shared MCP session is open. Does no network I/O.
+        """
+        return self._session is not None
+
+    async def test_connection(self):
+        """
+        Checks if the MCP server is reachable using the shared session.
+        Used at app startup for health checks; only the first call pays for the handshake.
+        """
+        try:
+            session = await self._ensure_session()
+            try:
+                await self._mcp_request(session.send_ping())
+            except McpError:
+                # Server does not support ping, fall back to the (cached) tool list
+                await self._get_tools()
         except Exception as e:
             raise RuntimeError(f"Failed to connect to MCP server: {e}")
 
-    async def process_query(self, query: str) -> str:
+    async def process_query_stream(self, query: str) -> AsyncIterator[str]:
         """
         Handles a user query by sending it to Claude with tool metadata,
-        processes any tool_use request by Claude via MCP, and returns the final response.
+        processes any tool_use request by Claude via MCP, and yields the response text as it is produced.
         """
+        probe = self._admit_query()
         try:
-            async with streamablehttp_client(self.server_url) as (read_stream, write_stream, _):
-                async with ClientSession(read_stream, write_stream) as session:
-                    await session.initialize()
+            async for chunk in self._run_query(query):
+                yield chunk
+            if probe and self._breaker_state == "half":
+                # The probe finished without an MCP failure re-opening the circuit
+                self._record_success()
+        finally:
+            if probe:
+                self._probe_in_flight = False
+
+    async def _run_query(self, query: str) -> AsyncIterator[str]:
+        """
+        Runs one query end to end; see process_query_stream.
+        """
+        # "!bust <query>" forces fresh Claude responses for this query
+        bypass_cache = query.startswith(CACHE_BUST_PREFIX)
+        if bypass_cache:
+            query = query.removeprefix(CACHE_BUST_PREFIX).lstrip()
+
+        try:
+            # Reuse the persistent MCP session (opened once, shared across queries)
+            session = await self._ensure_session()
+
+            # Step 1: Retrieve list of available tools (cached) from the MCP server
+            try:
+                available_tools = await self._get_tools()
+            except APIStatusError as e:
+                raise RuntimeError(
+                    f"Claude API error: {e.status_code} - {e.response}"
+                )
+
+            # Step 2: Prepare initial Claude message
+            messages = [{"role": "user", "content": query}]
 
-                    # Step 1: Retrieve list of available tools from the MCP server
-                    try:
-                        tool_response = await session.list_tools()
-                        available_tools = [
-                            {
-                                "name": tool.name,
-                                "description": tool.description,
-                                "input_schema": tool.inputSchema,
-                            }
-                            for tool in tool_response.tools
-                        ]
-                    except APIStatusError as e:
-                        raise RuntimeError(
-                            f"Claude API error: {e.status_code} - {e.response}"
-                        )
-
-                    # Step 2: Prepare initial Claude message
-                    messages = [{"role": "user", "content": query}]
-                    assistant_content = []
-                    final_text = []
-
-                    # Step 3: Call Claude with tools provided
-                    response = self.anthropic.messages.create(
-                        model="claude-3-5-sonnet-20241022",
-                        max_tokens=1000,
-                        system="You are a helpful AI assistant. The output should be human readable",
+            # Step 3: Stream Claude's answer with tools provided
+            async for chunk in self._stream_message(
+                bypass_cache=bypass_cache,
+                **_BASE_KWARGS,
+                messages=messages,
+                tools=available_tools,
+            ):
+                if isinstance(chunk, Message):
+                    response = chunk
+                else:
+                    yield chunk
+
+            # Fast path: a plain answer needs no tool bookkeeping or follow-up call
+            if not any(content.type == "tool_use" for content in response.content):
+                return
+
+            # Step 4: Collect the tool calls Claude requested
+            assistant_content = [
+                content for content in response.content if content.type in ("text", "tool_use")
+            ]
+            tool_uses = [content for content in assistant_content if content.type == "tool_use"]
+
+            # Step 5: Call all requested MCP tools concurrently
+            results = await asyncio.gather(
+                *(self._call_tool(session, content.name, content.input) for content in tool_uses),
+                return_exceptions=True,
+            )
+
+            tool_results = []
+            for content, tool_result in zip(tool_uses, results):
+                if isinstance(tool_result, BaseException):
+                    # If a tool call fails, add an error message to the response
+                    logger.error("Tool call failed: %s", tool_result, exc_info=tool_result)
+                    yield f"Error calling tool `{content.name}`: {tool_result}\n"
+                    tool_results.append({
+                        "type": "tool_result",
+                        "tool_use_id": content.id,
+                        "content": str(tool_result),
+                        "is_error": True,
+                    })
+                    continue
+
+                # Report tool call success and prepare context for follow-up
+                yield f"[Tool `{content.name}` called with args {content.input}]\n"
+                tool_results.append({
+                    "type": "tool_result",
+                    "tool_use_id": content.id,
+                    "content": tool_result.content,
+                })
+
+            # Only ask for a follow-up if at least one tool succeeded
+            if any(not result.get("is_error") for result in tool_results):
+                messages.extend([
+                    {
+                        "role": "assistant",
+                        "content": assistant_content,
+                    },
+                    {
+                        "role": "user",
+                        "content": tool_results,
+                    },
+                ])
+
+                try:
+                    # Step 6: Stream Claude's follow-up message after tool results
+                    async for chunk in self._stream_message(
+                        bypass_cache=bypass_cache,
+                        **_BASE_KWARGS,
                         messages=messages,
                         tools=available_tools,
-                    )
-
-                    # Step 4: Parse Claude's response
-                    for content in response.content:
-                        if content.type == "text":
-                            # Normal text response
-                            final_text.append(content.text)
-                            assistant_content.append(content)
-
-                        elif content.type == "tool_use":
-                            # Claude requested a tool call
-                            tool_name = content.name
-                            tool_args = content.input
-                            tool_id = content.id
-
-                            try:
-                                # Step 5: Call the requested MCP tool
-                                tool_result = await session.call_tool(tool_name, tool_args)
-
-                                # Log tool call success and prepare context for follow-up
-                                final_text.append(
-                                    f"[Tool `{tool_name}` called with args {tool_args}]"
-                                )
-                                assistant_content.append(content)
-                                messages.extend([
-                                    {
-                                        "role": "assistant",
-                                        "content": assistant_content,
-                                    },
-                                    {
-                                        "role": "user",
-                                        "content": [
-                                            {
-                                                "type": "tool_result",
-                                                "tool_use_id": tool_id,
-                                                "content": tool_result.content,
-                                            }
-                                        ],
-                                    },
-                                ])
-
-                                # Step 6: Ask Claude for a follow-up message after tool result
-                                response = self.anthropic.messages.create(
-                                    model="claude-3-5-sonnet-20241022",
-                                    max_tokens=1000,
-                                    messages=messages,
-                                    tools=available_tools,
-                                )
-
-                                for followup in response.content:
-                                    if followup.type == "text":
-                                        final_text.append(followup.text)
-
-                            except Exception as e:
-                                # If tool call fails, append an error message to the response
-                                print(f"Tool call failed: {e}")
-                                final_text.append(
-                                    f"Error calling tool `{tool_name}`: {e}"
-                                )
-
-            # Return the combined final response as a string
-            return "\n".join(final_text)
+                    ):
+                        if not isinstance(chunk, Message):
+                            yield chunk
+
+                except Exception as e:
+                    logger.exception("Tool follow-up failed: %s", e)
+                    yield f"Error processing tool results: {e}\n"
+
+        except* ClaudeBusyError as eg:
+            # Pass overload through as-is so the API can answer 503
+            raise eg.exceptions[0]
 
         except* Exception as eg:
             # Handle any grouped exceptions (PEP 654)
-            print(f"Unhandled ExceptionGroup:\n{eg}")
-            for ex in eg.exceptions:
-                print(f"  - {type(ex).__name__}: {ex}")
-                traceback.print_exception(type(ex), ex, ex.__traceback__)
-            raise RuntimeError(f"Error processing query via MCP: {eg}")
+            logger.exception("Unhandled ExceptionGroup: %s", eg)
+            raise RuntimeError(f"Error processing query via MCP: {_unwrap(eg)}")
+
+    async def process_query(self, query: str) -> str:
+        """
+        Buffered variant of process_query_stream that returns the whole response as one string.
+        """
+        buf = io.StringIO()
+        async for chunk in self.process_query_stream(query):
+            buf.write(chunk)
+        return buf.getvalue().rstrip("\n")
 
     async def cleanup(self) -> None:
         """
@@ -152,7 +564,9 @@ class MCPClient:
         Call this during shutdown if needed.
         """
         try:
-            await self.exit_stack.aclose()
-            print("[MCPClient] Cleanup successful.")
+            await self._close_session()
+            await self._http.aclose()
+            self.response_cache.close()
+            logger.info("[MCPClient] Cleanup successful.")
         except Exception as e:
-            print(f"[MCPClient] Cleanup error: {e}")
+            logger.exception("[MCPClient] Cleanup error: %s", e)
@@ -1,13 +1,22 @@
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
 from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from contextlib import asynccontextmanager
-from typing import AsyncGenerator
-from pydantic import BaseModel
+from typing import AsyncGenerator, AsyncIterator
+from pydantic import BaseModel, ConfigDict
+
+from client import ClaudeBusyError, MCPClient  # Import your custom MCPClient to interact with MCP server
 
-from client import MCPClient  # Import your custom MCPClient to interact with MCP server
+logger = logging.getLogger("mcp_client")
 
-# Initialize the MCP client instance
-mcp_client = MCPClient()
+# Created in lifespan, so importing this module (uvicorn imports it once more
+# in every worker) doesn't open extra HTTP pools, SQLite connections or log queues
+mcp_client: MCPClient | None = None
 
 
 # Lifespan handler to test MCP server connection during startup
@@ -15,21 +24,47 @@ mcp_client = MCPClient()
 async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     """
     This function runs when the FastAPI app starts and shuts down.
-    It ensures the MCP server is reachable before continuing.
+    It ensures the MCP server is reachable before continuing and
+    keeps a single MCP session open for the lifetime of the app.
     """
+    global mcp_client
+
+    # Log through a queue so the event loop never blocks on stdout;
+    # a background listener thread does the actual writing
+    log_queue: queue.Queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.addHandler(queue_handler)
+    log_listener.start()
+
+    # Initialize the MCP client instance
+    mcp_client = MCPClient()
     try:
-        print("🔌 Testing MCP server connection on startup...")
-        await mcp_client.test_connection()  # Ping MCP server
-        print("✅ MCP server is reachable.")
+        try:
+            logger.info("🔌 Testing MCP server connection on startup...")
+            await mcp_client.test_connection()  # Open the shared MCP session and ping it
+            logger.info("✅ MCP server is reachable.")
+        except Exception as e:
+            logger.error("❌ MCP server connection failed: %s", e)
+            raise RuntimeError(f"MCP connection failed: {e}")
+
         yield
-    except Exception as e:
-        print(f"❌ MCP server connection failed: {e}")
-        raise RuntimeError(f"MCP connection failed: {e}")
+    finally:
+        # Close the shared MCP session on shutdown, then flush pending logs
+        await mcp_client.cleanup()
+        mcp_client = None
+        logger.removeHandler(queue_handler)
+        log_listener.stop()
 
 
 # Initialize FastAPI app with lifespan management
 app = FastAPI(
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,  # Serialize JSON responses with orjson
     title="Sample MCP Client with FastAPI",
     version="1.0.0",
     description="This is a sample MCP Client using FastAPI. It connects to an MCP server and sends user queries to it.",
@@ -38,6 +73,9 @@ app = FastAPI(
 
 # Request body model for /query endpoint
 class QueryRequest(BaseModel):
+    # Strict mode skips type coercion on this hot path; frozen skips assignment validation
+    model_config = ConfigDict(strict=True, frozen=True)
+
     query: str  # User query to be processed by MCP server
 
 
@@ -55,30 +93,89 @@ async def app_status_check():
     }
 
 
+# Liveness route reporting MCP session state without touching the network
+@app.get("/healthz")
+async def healthz():
+    """
+    Reports whether the shared MCP session is open.
+    """
+    return {"mcp": mcp_client.is_connected}
+
+
+async def _relay(first_chunk: str, stream: AsyncIterator[str]) -> AsyncIterator[str]:
+    """
+    Re-emits the already received first chunk followed by the rest of the stream.
+    The status code is already sent by then, so a later failure ends the body with an error line.
+    """
+    yield first_chunk
+    try:
+        async for chunk in stream:
+            yield chunk
+    except Exception as e:
+        logger.error("Query failed while streaming: %s", e)
+        yield f"\nError processing query: {e}\n"
+
+
 # POST endpoint to handle user queries and forward them to the MCP server
 @app.post("/query")
 async def handle_query(request: QueryRequest):
     """
     Accepts a user query, forwards it to the MCP server,
-    and returns the response back to the caller.
+    and streams the response back to the caller as plain text.
 
     Expected body: { "query": "your question or command here" }
     """
     try:
-        print(f"📥 Received query: {request.query}")
+        logger.info("📥 Received query: %s", request.query)
 
-        # Forward the query to MCP and await the response
-        response = await mcp_client.process_query(request.query)
-        print(f"📤 Response from MCP: {response}")
+        # Forward the query to MCP and wait for the first chunk,
+        # so failures before streaming starts still return an error status
+        stream = mcp_client.process_query_stream(request.query)
+        first_chunk = await anext(stream, "")
+        logger.info("📤 Streaming response from MCP")
 
-        return {"response": response}
+        return StreamingResponse(_relay(first_chunk, stream), media_type="text/plain")
     
+    except ClaudeBusyError as e:
+        # Too many queries are already waiting on Claude
+        logger.warning("Claude busy: %s", e)
+        raise HTTPException(status_code=503, detail=str(e))
+
     except RuntimeError as e:
         # Raised when MCP client fails internally
-        print(f"Runtime error: {e}")
+        logger.error("Runtime error: %s", e)
         raise HTTPException(status_code=500, detail=str(e))
     
     except Exception as e:
         # For any other unexpected errors
-        print(f"Unexpected error: {e}")
-        return JSONResponse(status_code=400, content={"detail": str(e)})
+        logger.exception("Unexpected error: %s", e)
+        return ORJSONResponse(status_code=400, content={"detail": str(e)})
+
+
+# Admin route to drop the cached MCP tool list (e.g. after the server adds tools)
+@app.post("/tools/refresh")
+async def refresh_tools():
+    """
+    Invalidates the cached MCP tool list so it is re-fetched on the next query.
+    """
+    mcp_client.invalidate_tools()
+    return {"status": "Tool cache invalidated"}
+
+
+# Production entry point: `python main.py`
+if __name__ == "__main__":
+    import uvicorn
+
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    # Workers read this to split the MCP_MAX_INFLIGHT budget between them
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+
+    # Each worker process runs its own lifespan, so each opens its own MCP session
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8001,
+        workers=workers,
+        loop="uvloop" if sys.platform != "win32" else "auto",
+        http="httptools",
+    )